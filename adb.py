@@ -7,12 +7,25 @@
 # Distributed under the "BSD License". See the accompanying LICENSE.rst file.
 
 import argparse
+import ast
+import socket
 import subprocess
+import sys
 import threading
 import time
 import os
 import re
 
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 BUTTONS = {
     "soft_right": 2,
     "home": 3,
@@ -99,27 +112,194 @@ BUTTONS = {
     "search": 84
 }
 
+# The names of all the Android KEYCODE_* constants in the order of their
+# values, i.e. KEYCODE_HOME is 3. Parsed on first use by keycode().
+KEYCODE_NAMES = """
+UNKNOWN SOFT_LEFT SOFT_RIGHT HOME BACK CALL ENDCALL 0 1 2 3 4 5 6 7 8 9 STAR
+POUND DPAD_UP DPAD_DOWN DPAD_LEFT DPAD_RIGHT DPAD_CENTER VOLUME_UP VOLUME_DOWN
+POWER CAMERA CLEAR A B C D E F G H I J K L M N O P Q R S T U V W X Y Z COMMA
+PERIOD ALT_LEFT ALT_RIGHT SHIFT_LEFT SHIFT_RIGHT TAB SPACE SYM EXPLORER
+ENVELOPE ENTER DEL GRAVE MINUS EQUALS LEFT_BRACKET RIGHT_BRACKET BACKSLASH
+SEMICOLON APOSTROPHE SLASH AT NUM HEADSETHOOK FOCUS PLUS MENU NOTIFICATION
+SEARCH MEDIA_PLAY_PAUSE MEDIA_STOP MEDIA_NEXT MEDIA_PREVIOUS MEDIA_REWIND
+MEDIA_FAST_FORWARD MUTE PAGE_UP PAGE_DOWN PICTSYMBOLS SWITCH_CHARSET BUTTON_A
+BUTTON_B BUTTON_C BUTTON_X BUTTON_Y BUTTON_Z BUTTON_L1 BUTTON_R1 BUTTON_L2
+BUTTON_R2 BUTTON_THUMBL BUTTON_THUMBR BUTTON_START BUTTON_SELECT BUTTON_MODE
+ESCAPE FORWARD_DEL CTRL_LEFT CTRL_RIGHT CAPS_LOCK SCROLL_LOCK META_LEFT
+META_RIGHT FUNCTION SYSRQ BREAK MOVE_HOME MOVE_END INSERT FORWARD MEDIA_PLAY
+MEDIA_PAUSE MEDIA_CLOSE MEDIA_EJECT MEDIA_RECORD F1 F2 F3 F4 F5 F6 F7 F8 F9 F10
+F11 F12 NUM_LOCK NUMPAD_0 NUMPAD_1 NUMPAD_2 NUMPAD_3 NUMPAD_4 NUMPAD_5 NUMPAD_6
+NUMPAD_7 NUMPAD_8 NUMPAD_9 NUMPAD_DIVIDE NUMPAD_MULTIPLY NUMPAD_SUBTRACT
+NUMPAD_ADD NUMPAD_DOT NUMPAD_COMMA NUMPAD_ENTER NUMPAD_EQUALS NUMPAD_LEFT_PAREN
+NUMPAD_RIGHT_PAREN VOLUME_MUTE INFO CHANNEL_UP CHANNEL_DOWN ZOOM_IN ZOOM_OUT TV
+WINDOW GUIDE DVR BOOKMARK CAPTIONS SETTINGS TV_POWER TV_INPUT STB_POWER
+STB_INPUT AVR_POWER AVR_INPUT PROG_RED PROG_GREEN PROG_YELLOW PROG_BLUE
+APP_SWITCH BUTTON_1 BUTTON_2 BUTTON_3 BUTTON_4 BUTTON_5 BUTTON_6 BUTTON_7
+BUTTON_8 BUTTON_9 BUTTON_10 BUTTON_11 BUTTON_12 BUTTON_13 BUTTON_14 BUTTON_15
+BUTTON_16 LANGUAGE_SWITCH MANNER_MODE 3D_MODE CONTACTS CALENDAR MUSIC
+CALCULATOR ZENKAKU_HANKAKU EISU MUHENKAN HENKAN KATAKANA_HIRAGANA YEN RO KANA
+ASSIST BRIGHTNESS_DOWN BRIGHTNESS_UP MEDIA_AUDIO_TRACK SLEEP WAKEUP PAIRING
+MEDIA_TOP_MENU 11 12 LAST_CHANNEL TV_DATA_SERVICE VOICE_ASSIST TV_RADIO_SERVICE
+TV_TELETEXT TV_NUMBER_ENTRY TV_TERRESTRIAL_ANALOG TV_TERRESTRIAL_DIGITAL
+TV_SATELLITE TV_SATELLITE_BS TV_SATELLITE_CS TV_SATELLITE_SERVICE TV_NETWORK
+TV_ANTENNA_CABLE TV_INPUT_HDMI_1 TV_INPUT_HDMI_2 TV_INPUT_HDMI_3
+TV_INPUT_HDMI_4 TV_INPUT_COMPOSITE_1 TV_INPUT_COMPOSITE_2 TV_INPUT_COMPONENT_1
+TV_INPUT_COMPONENT_2 TV_INPUT_VGA_1 TV_AUDIO_DESCRIPTION
+TV_AUDIO_DESCRIPTION_MIX_UP TV_AUDIO_DESCRIPTION_MIX_DOWN TV_ZOOM_MODE
+TV_CONTENTS_MENU TV_MEDIA_CONTEXT_MENU TV_TIMER_PROGRAMMING HELP
+NAVIGATE_PREVIOUS NAVIGATE_NEXT NAVIGATE_IN NAVIGATE_OUT STEM_PRIMARY STEM_1
+STEM_2 STEM_3 DPAD_UP_LEFT DPAD_DOWN_LEFT DPAD_UP_RIGHT DPAD_DOWN_RIGHT
+MEDIA_SKIP_FORWARD MEDIA_SKIP_BACKWARD MEDIA_STEP_FORWARD MEDIA_STEP_BACKWARD
+SOFT_SLEEP CUT COPY PASTE SYSTEM_NAVIGATION_UP SYSTEM_NAVIGATION_DOWN
+SYSTEM_NAVIGATION_LEFT SYSTEM_NAVIGATION_RIGHT ALL_APPS REFRESH THUMBS_UP
+THUMBS_DOWN PROFILE_SWITCH
+"""
+
+KEYCODES = None
+
+
+def keycode(button):
+    """Return the key code of a button.
+
+    The button is either one of the BUTTONS or the name of a KEYCODE_*
+    constant with or without the prefix, in any case. Numbers are names
+    too, i.e. '9' is KEYCODE_9, not key code 9. Raises KeyError for unknown
+    buttons.
+    """
+    global KEYCODES
+    if button in BUTTONS:
+        return BUTTONS[button]
+    if KEYCODES is None:
+        KEYCODES = {name: code for code, name in
+                    enumerate(KEYCODE_NAMES.split())}
+    name = str(button).upper()
+    if name.startswith('KEYCODE_'):
+        name = name[len('KEYCODE_'):]
+    return KEYCODES[name]
+
+
+class Output(object):
+    """Captured output of a command, only decoded when text is needed."""
+
+    def __init__(self, data, truncated=False):
+        """initialize output from the captured bytes."""
+        super(Output, self).__init__()
+        self.data = data
+        self.truncated = truncated
+        self.__text = None
+
+    @property
+    def text(self):
+        """The output decoded as text."""
+        if self.__text is None:
+            self.__text = self.data.decode('utf-8', 'replace')
+        return self.__text
+
+    def strip(self):
+        """Return the text without surrounding whitespace."""
+        return self.text.strip()
+
+    def splitlines(self):
+        """Return the lines of the text."""
+        return self.text.splitlines()
+
+    def __contains__(self, substring):
+        # Search the raw bytes, which doesn't require decoding.
+        if not isinstance(substring, bytes):
+            substring = substring.encode('utf-8')
+        return self.data.find(substring) != -1
+
+    def __len__(self):
+        return len(self.data)
+
+    def __bool__(self):
+        return len(self.data) > 0
+
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        return self.text
+
 
 class Command(object):
     """Wrapper for Popen which supports a timeout."""
 
-    def __init__(self, cmd, timeout):
-        """initialize command."""
+    CHUNK_SIZE = 64 * 1024
+    MAX_OUTPUT = 4 * 1024 * 1024
+
+    def __init__(self, cmd, timeout, max_output=MAX_OUTPUT,
+                 line_callback=None, stdin=None):
+        """initialize command.
+
+        At most max_output bytes of stdout and stderr are kept, None
+        means no limit. If given, line_callback is called with the bytes of
+        each line of stdout, without the newline, as it arrives, including
+        the lines which aren't kept. stdin
+        is passed on to Popen, e.g. a file to stream to the command.
+        """
         super(Command, self).__init__()
         self.cmd = cmd
         self.timeout = timeout
+        self.stdin = stdin
+        self.max_output = max_output
+        self.line_callback = line_callback
         self.process = None
         self.result = None
 
+    def __read(self, stream, line_callback=None):
+        output = bytearray()
+        truncated = False
+        pending = bytearray()
+        # The chunk buffer is reused for every read, only the part which
+        # is kept is copied.
+        buffer = bytearray(self.CHUNK_SIZE)
+        view = memoryview(buffer)
+        while True:
+            size = stream.readinto(buffer)
+            if not size:
+                break
+            chunk = view[:size]
+            if line_callback:
+                pending += chunk
+                start = 0
+                end = pending.find(b'\n')
+                while end != -1:
+                    line_callback(bytes(pending[start:end]))
+                    start = end + 1
+                    end = pending.find(b'\n', start)
+                del pending[:start]
+            if self.max_output is None:
+                output += chunk
+                continue
+            keep = self.max_output - len(output)
+            if keep > 0:
+                output += chunk[:keep]
+            if size > keep:
+                truncated = True
+        if line_callback and pending:
+            line_callback(bytes(pending))
+        return Output(output, truncated)
+
     def run(self):
         """Run command."""
         def target():
             self.process = subprocess.Popen(
                 self.cmd,
+                stdin=self.stdin,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-
-            self.result = self.process.communicate()
+                stderr=subprocess.PIPE,
+                bufsize=0)
+
+            stderr = []
+            stderr_thread = threading.Thread(
+                target=lambda: stderr.append(self.__read(self.process.stderr)))
+            stderr_thread.start()
+            stdout = self.__read(self.process.stdout, self.line_callback)
+            stderr_thread.join()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process.stderr.close()
+            self.result = (stdout, stderr[0])
         thread = threading.Thread(
             target=target,
             name=" ".join(self.cmd))
@@ -139,19 +319,299 @@ class Command(object):
             return (None, None, None)
 
 
+class CommandTemplate(object):
+    """adb shell command with a prefix which is only quoted once."""
+
+    def __init__(self, adb, prefix):
+        """initialize template from the fixed arguments of the command."""
+        super(CommandTemplate, self).__init__()
+        self.adb = adb
+        self.prefix = " ".join(quote(str(arg)) for arg in prefix)
+
+    def line(self, *args):
+        """Return the quoted command line with args after the prefix."""
+        return " ".join([self.prefix] + [quote(str(arg)) for arg in args])
+
+    def argv(self, handle, line):
+        """Return the command running line on the device with handle."""
+        # adb shell joins its arguments with spaces and the shell on the
+        # device splits them again, so pass the quoted line as one.
+        return [self.adb, '-s', handle, 'shell', line]
+
+
+class Version(tuple):
+    """Android version, which also compares with numbers and strings."""
+
+    def __new__(cls, value):
+        """create version from e.g. '7.1.2', '7.0', 7 or 7.1."""
+        if not isinstance(value, tuple):
+            try:
+                value = tuple(int(v) for v in str(value).split('.'))
+            except ValueError:
+                value = ()
+        if not value or len(value) > 3:
+            value = (0, 0, 0)
+        return tuple.__new__(cls, tuple(value) + (0,) * (3 - len(value)))
+
+    def __str__(self):
+        """Return the version as major.minor.patch."""
+        return "{}.{}.{}".format(*self)
+
+    def __eq__(self, other):
+        return tuple.__eq__(self, Version(other))
+
+    def __ne__(self, other):
+        return tuple.__ne__(self, Version(other))
+
+    def __lt__(self, other):
+        return tuple.__lt__(self, Version(other))
+
+    def __le__(self, other):
+        return tuple.__le__(self, Version(other))
+
+    def __gt__(self, other):
+        return tuple.__gt__(self, Version(other))
+
+    def __ge__(self, other):
+        return tuple.__ge__(self, Version(other))
+
+    __hash__ = tuple.__hash__
+
+
+class Selector(object):
+    """Device selector expression, e.g. "model=='Nexus 4' and version>=7"."""
+
+    FIELDS = ['serial', 'brand', 'model', 'version', 'battery', 'state']
+
+    NODES = tuple(getattr(ast, name) for name in [
+        'Expression', 'BoolOp', 'And', 'Or', 'UnaryOp', 'Not', 'Compare',
+        'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE', 'In', 'NotIn', 'Name',
+        'Load', 'Tuple', 'List', 'Constant', 'Str', 'Num', 'NameConstant']
+        if hasattr(ast, name))
+
+    def __init__(self, expression):
+        """initialize selector, raises ValueError if invalid."""
+        super(Selector, self).__init__()
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except SyntaxError as e:
+            raise ValueError("invalid syntax: {}".format(e.msg))
+        self.names = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, self.NODES):
+                raise ValueError("'{}' is not supported".format(
+                    type(node).__name__))
+            if isinstance(node, ast.Name):
+                if node.id not in self.FIELDS:
+                    raise ValueError("unknown field '{}', use one of: "
+                                     "{}".format(node.id,
+                                                 ", ".join(self.FIELDS)))
+                self.names.add(node.id)
+        self.code = compile(tree, '<selector>', 'eval')
+
+    def matches(self, info):
+        """Check if the device described by info matches."""
+        try:
+            return bool(eval(self.code, {'__builtins__': {}}, dict(info)))
+        except TypeError:
+            # E.g. comparing a missing battery level with a number.
+            return False
+
+
+class Throttle(object):
+    """Token bucket limiting the combined rate of several streams."""
+
+    def __init__(self, rate):
+        """initialize throttle, rate is in bytes/s or None for no limit."""
+        super(Throttle, self).__init__()
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self, size):
+        """Account for size bytes, sleeping if the rate is exceeded."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.next_time = max(now, self.next_time) + size / float(self.rate)
+            delay = self.next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ThrottledReader(object):
+    """File-like wrapper which reads a stream through a Throttle."""
+
+    def __init__(self, stream, throttle):
+        """initialize reader."""
+        super(ThrottledReader, self).__init__()
+        self.stream = stream
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        """Read from the stream."""
+        data = self.stream.read(size)
+        self.throttle.consume(len(data))
+        return data
+
+
+class Channel(object):
+    """Persistent 'adb shell' on a device which commands can be sent to."""
+
+    ACK = '__adb_py_ack__'
+
+    def __init__(self, adb, handle):
+        """initialize channel, starting the shell."""
+        super(Channel, self).__init__()
+        self.handle = handle
+        self.devnull = open(os.devnull, 'w')
+        self.process = subprocess.Popen(
+            [adb, '-s', handle, 'shell'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self.devnull,
+            bufsize=0)
+        # Lines are read by a thread, so waiting for them can time out.
+        self.lines = queue.Queue()
+        self.reader = threading.Thread(target=self.__read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def __read(self):
+        for line in iter(self.process.stdout.readline, b''):
+            self.lines.put(line)
+        self.lines.put(None)
+
+    def send(self, line):
+        """Send a command line followed by an acknowledgement request."""
+        line = '{}; echo {}\n'.format(line, self.ACK)
+        self.process.stdin.write(line.encode('utf-8'))
+        self.process.stdin.flush()
+
+    def wait_ack(self, timeout):
+        """Wait for the acknowledgement.
+
+        Returns False if the shell died or didn't answer within timeout
+        seconds.
+        """
+        ack = self.ACK.encode('utf-8')
+        deadline = time.time() + timeout
+        while True:
+            try:
+                line = self.lines.get(
+                    timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                return False
+            if line is None:
+                return False
+            if line.strip() == ack:
+                return True
+
+    def close(self):
+        """Exit the shell, killing it if it doesn't exit by itself."""
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        deadline = time.time() + 1
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.reader.join()
+        self.process.stdout.close()
+        self.devnull.close()
+
+
 class ADB(object):
     """docstring for ADB."""
 
-    def __init__(self, adb, threads, specific_devices):
+    def __init__(self, adb, threads, specific_devices, where=None,
+                 sync=False):
         """initialize ADB."""
         super(ADB, self).__init__()
         self.adb = adb
-        self.cmd_semaphore = threading.BoundedSemaphore(value=threads)
+        self.threads = threads
         self.print_mutex = threading.Lock()
-        self.__run([self.adb, 'start-server'])
         self.specific_devices = specific_devices
+        self.where = where
+        self.sync = sync
+        # Device properties by handle, filled in by __describe.
+        self.__device_info = {}
+        self.__device_info_mutex = threading.Lock()
+        # Templates of the input commands, which may be run many times.
+        self.__start_template = CommandTemplate(adb, ['am', 'start'])
+        self.__press_template = CommandTemplate(adb, ['input', 'keyevent'])
+        self.__tap_template = CommandTemplate(adb, ['input', 'tap'])
+        # The semaphore and the adb server are set up on first use, so
+        # that invocations which are done early don't pay for them.
+        self.__setup_mutex = threading.Lock()
+        self.__server_mutex = threading.Lock()
+        self.__cmd_semaphore = None
+        self.__server_running = False
+
+    @property
+    def cmd_semaphore(self):
+        """Semaphore limiting the number of concurrent adb processes."""
+        if self.__cmd_semaphore is None:
+            with self.__setup_mutex:
+                if self.__cmd_semaphore is None:
+                    self.__cmd_semaphore = \
+                        threading.BoundedSemaphore(value=self.threads)
+        return self.__cmd_semaphore
+
+    def __host_request(self, request, timeout):
+        # Send a host request directly to the adb server socket. Returns
+        # the connection if the server answered OKAY, otherwise None.
+        port = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+        try:
+            connection = socket.create_connection(
+                ('127.0.0.1', port), timeout)
+        except (socket.error, socket.timeout):
+            return None
+        try:
+            request = request.encode('ascii')
+            connection.sendall(('%04x' % len(request)).encode('ascii'))
+            connection.sendall(request)
+            if self.__recv_exactly(connection, 4) == b'OKAY':
+                return connection
+        except (socket.error, socket.timeout):
+            pass
+        connection.close()
+        return None
+
+    def __recv_exactly(self, connection, size):
+        data = b''
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                raise socket.error('connection closed by adb server')
+            data += chunk
+        return data
+
+    def __probe_server(self):
+        # Ask the adb server for its version, this is much faster than
+        # spawning 'adb start-server' when the server is already up.
+        connection = self.__host_request('host:version', 0.5)
+        if connection is None:
+            return False
+        connection.close()
+        return True
+
+    def __start_server(self):
+        if self.__server_running:
+            return
+        with self.__server_mutex:
+            if self.__server_running:
+                return
+            if not self.__probe_server():
+                self.__run([self.adb, 'start-server'])
+            self.__server_running = True
 
-    def __run(self, cmd, timeout=20, print_cmd=False):
+    def __run(self, cmd, timeout=20, print_cmd=False,
+              max_output=Command.MAX_OUTPUT, line_callback=None, stdin=None):
         stdout = None
         stderr = None
         returncode = None
@@ -160,12 +620,16 @@ class ADB(object):
             if print_cmd:
                 self.__print(" ".join(cmd))
 
-            command = Command(cmd, timeout)
+            command = Command(cmd, timeout, max_output, line_callback, stdin)
             stdout, stderr, returncode = command.run()
 
         except Exception as e:
-            self.__print("Error: ".format(e.message, " ".join(cmd)))
+            self.__print("Error: {} ({})".format(e, " ".join(cmd)))
         finally:
+            for output in [stdout, stderr]:
+                if output is not None and output.truncated and max_output:
+                    self.__print("Warning: output of '{}' truncated to {} "
+                                 "bytes.".format(" ".join(cmd), max_output))
             if print_cmd and stdout:
                 self.__print(stdout.strip())
             if print_cmd and stderr:
@@ -180,11 +644,12 @@ class ADB(object):
         self.print_mutex.release()
 
     def __get_devices(self):
+        self.__start_server()
         outputs, _, _ = self.__run([self.adb, 'devices'])
         if not outputs:
             return []
 
-        outputs = [i for i in outputs.split('\n')[1:] if i]
+        outputs = [i for i in outputs.splitlines()[1:] if i]
         devices = {}
         for output in outputs:
             output = output.split()
@@ -199,26 +664,76 @@ class ADB(object):
                 if device_id not in self.specific_devices:
                     continue
             devices[device_id] = {'handle': device_id}
+
+        if self.where and devices:
+            self.__index(list(devices), self.where.names)
+            devices = {d: devices[d] for d in devices
+                       if self.where.matches(self.__device_info[d])}
         return devices
 
-    def __get_prop(self, handle, prop):
+    def __get_prop(self, handle, prop, timeout=20):
         cmd = [self.adb, '-s', handle, 'shell',
                'getprop', prop]
+        result, _, _ = self.__run(cmd, timeout=timeout)
+        if not result:
+            return ""
+        return result.strip()
+
+    def __get_props(self, handle):
+        # Fetch all properties with a single getprop.
+        cmd = [self.adb, '-s', handle, 'shell', 'getprop']
         result, _, _ = self.__run(cmd)
+        if not result:
+            return {}
+        props = {}
+        for line in result.splitlines():
+            match = re.match(r"\[(.*)\]: \[(.*)\]", line.strip())
+            if match:
+                props[match.group(1)] = match.group(2)
+        return props
+
+    def __describe(self, handle, fields):
+        # Fill in the requested fields of the device's entry in the index,
+        # only fetching what isn't already known.
+        with self.__device_info_mutex:
+            info = self.__device_info.setdefault(handle, {'serial': handle})
+        missing = [field for field in fields if field not in info]
+        if not missing:
+            return info
+
+        if set(missing) & set(['brand', 'model', 'version']) or \
+                'off' not in info and 'state' in missing:
+            props = self.__get_props(handle)
+            info['brand'] = props.get('ro.product.brand', '')
+            info['model'] = props.get('ro.product.model', '')
+            info['version'] = Version(
+                props.get('ro.build.version.release', ''))
+            # adb is set to unsecure when the table is off.
+            info['off'] = props.get('ro.adb.secure') == '0'
+        if 'battery' in missing:
+            battery = self.__battery(handle)
+            info['battery'] = int(battery) if battery.isdigit() else None
+        if 'state' in missing:
+            if info['off']:
+                info['state'] = 'device off'
+            elif self.__is_screen_on(handle):
+                info['state'] = 'screen on'
+            else:
+                info['state'] = 'screen off'
+        return info
+
+    def __index(self, handles, fields):
+        self.__dispatch(self.__describe, handles, dict(fields=fields))
+
+    def __get_state(self, handle, timeout=20):
+        cmd = [self.adb, '-s', handle, 'get-state']
+        result, _, _ = self.__run(cmd, timeout=timeout)
         if not result:
             return ""
         return result.strip()
 
     def __version(self, handle):
-        version_string = self.__get_prop(handle, 'ro.build.version.release')
-        if version_string == "7.0":
-            version_string = "7.0.0"
-        version_split = version_string.split('.')
-        if len(version_split) != 3:
-            return (0, 0, 0)
-
-        major, minor, patch = version_split
-        return (int(major), int(minor), int(patch))
+        return Version(self.__get_prop(handle, 'ro.build.version.release'))
 
     def __ip(self, handle):
         return self.__get_prop(handle, 'dhcp.wlan0.ipaddress')
@@ -245,24 +760,22 @@ class ADB(object):
 
         return result.strip()
 
-    def __is_screen_locked(self, handle):
+    def __is_screen_locked(self, handle, timeout=20):
         cmd = [self.adb, '-s', handle, 'shell', 'dumpsys statusbar']
-        output, _, _ = self.__run(cmd)
+        output, _, _ = self.__run(cmd, timeout=timeout)
         if not output:
             return True
-        output = output.strip()
         result = 'mDisabled=0x1e00000' in output
         result |= 'mDisabled1=0x3200000' in output
         return result
 
-    def __is_screen_on(self, handle):
+    def __is_screen_on(self, handle, timeout=20):
         cmd = [self.adb, '-s', handle, 'shell', 'dumpsys power']
-        output, _, _ = self.__run(cmd)
+        output, _, _ = self.__run(cmd, timeout=timeout)
 
         if not output:
             return False
 
-        output = output.strip()
         result = 'mScreenOn=true' in output or \
                  'SCREEN_ON_BIT' in output or \
                  'Display Power: state=ON' in output
@@ -274,7 +787,7 @@ class ADB(object):
         if version[0] <= 4 and version[1] < 3:
             cmd = [self.adb, '-s', handle, 'shell', 'dumpsys window windows']
             output, stderr, _ = self.__run(cmd)
-            result = re.search("Display: init=(\d+)x(\d+)", output)
+            result = re.search("Display: init=(\d+)x(\d+)", output.text)
             if result is None:
                 return (0, 0)
             width = int(result.group(1))
@@ -283,7 +796,7 @@ class ADB(object):
 
         cmd = [self.adb, '-s', handle, 'shell', 'wm size']
         output, stderr, _ = self.__run(cmd)
-        result = re.search("Physical size: (\d+)x(\d+)", output)
+        result = re.search("Physical size: (\d+)x(\d+)", output.text)
         if result is None:
             return (0, 0)
         width = int(result.group(1))
@@ -327,9 +840,108 @@ class ADB(object):
         cmd = [self.adb, '-s', handle, 'install', '-r', apk]
         return self.__run(cmd, timeout=40)
 
-    def __running(self, handle, package_name):
+    def __last_line(self, result):
+        stdout, stderr, _ = result
+        for output in [stdout, stderr]:
+            lines = output.splitlines() if output else []
+            lines = [line.strip() for line in lines if line.strip()]
+            if lines:
+                return lines[-1]
+        return "no output"
+
+    def __install_write(self, handle, session, index, apk):
+        name = "{}_{}".format(index, os.path.basename(apk))
+        cmd = [self.adb, '-s', handle, 'exec-in', 'pm', 'install-write',
+               '-S', str(os.path.getsize(apk)), session, name, '-']
+        with open(apk, 'rb') as f:
+            return self.__last_line(self.__run(cmd, timeout=120, stdin=f))
+
+    def __install_session(self, handle, apks):
+        # Install the APKs of one application, i.e. a base APK and its
+        # splits, in a single session with the APKs written in parallel.
+        # Returns the result of each APK and the time spent in each phase.
+        phases = {}
+        start = time.time()
+        size = sum(os.path.getsize(apk) for apk in apks)
+        cmd = [self.adb, '-s', handle, 'shell',
+               'pm', 'install-create', '-r', '-S', str(size)]
+        result = self.__last_line(self.__run(cmd))
+        session = re.search(r"\[(\d+)\]", result)
+        phases['create'] = time.time() - start
+        if session is None:
+            # Devices without install sessions, use install(-multiple).
+            start = time.time()
+            if len(apks) == 1:
+                result = self.__install(handle, apks[0])
+            else:
+                cmd = [self.adb, '-s', handle, 'install-multiple', '-r']
+                cmd += [os.path.abspath(apk) for apk in apks]
+                result = self.__run(cmd, timeout=40 * len(apks))
+            phases['install'] = time.time() - start
+            return [self.__last_line(result)] * len(apks), phases
+        session = session.group(1)
+
+        start = time.time()
+        writes = [None] * len(apks)
+
+        def write(index):
+            writes[index] = self.__install_write(
+                handle, session, index, apks[index])
+        threads = [threading.Thread(target=write, args=(index,))
+                   for index in range(len(apks))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        phases['write'] = time.time() - start
+
+        if not all(w.startswith('Success') for w in writes):
+            cmd = [self.adb, '-s', handle, 'shell',
+                   'pm', 'install-abandon', session]
+            self.__run(cmd)
+            return [w if not w.startswith('Success') else
+                    "Failure [session abandoned]" for w in writes], phases
+
+        start = time.time()
+        cmd = [self.adb, '-s', handle, 'shell',
+               'pm', 'install-commit', session]
+        result = self.__last_line(self.__run(cmd, timeout=40))
+        phases['commit'] = time.time() - start
+        return [result] * len(apks), phases
+
+    def __install_apps(self, handle, apps):
+        # A session only holds the APKs of a single package, so each
+        # application gets its own session, and the sessions run in
+        # parallel on the device.
+        results = [None] * len(apps)
+        phases = [{}] * len(apps)
+
+        def install(index):
+            try:
+                results[index], phases[index] = \
+                    self.__install_session(handle, apps[index])
+            except (IOError, OSError) as e:
+                results[index] = ["Failure [{}]".format(e)] * len(apps[index])
+        threads = [threading.Thread(target=install, args=(index,))
+                   for index in range(len(apps))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # The sessions overlap, so report the longest time of each phase.
+        longest = {}
+        for session in phases:
+            for phase in session:
+                longest[phase] = max(longest.get(phase, 0), session[phase])
+        return (handle, [result for app in results for result in app],
+                longest)
+
+    def __running(self, handle, package_name, timeout=20):
         cmd = [self.adb, '-s', handle, 'shell', 'ps']
-        output, _, _ = self.__run(cmd)
+        output, _, _ = self.__run(cmd, timeout=timeout)
+        if not output:
+            return (handle, False)
         return (handle, any(
             [line.endswith(package_name) for line in output.splitlines()]))
 
@@ -357,29 +969,39 @@ class ADB(object):
                'am', 'force-stop', package_name]
         self.__run(cmd)
 
-    def __start(self, handle, package_name, activity='MainActivity',
-                action=None, data_string=None, parameters={}):
-        cmd = [self.adb, '-s', handle, 'shell', 'am', 'start', '-n']
+    def __run_template(self, handle, template, line):
+        self.__run(template.argv(handle, line))
+
+    def __start_line(self, package_name, activity='MainActivity',
+                     action=None, data_string=None, parameters={}):
+        args = ['-n']
 
-        cmd.append('{package_name}/.{activity}'.format(
+        args.append('{package_name}/.{activity}'.format(
             package_name=package_name, activity=activity))
 
-        if data_string is not None:
-            cmd.append('-d {data_string}'.format(data_string=data_string))
+        if data_string:
+            args += ['-d', data_string]
 
-        if action is not None:
-            cmd.append('-a {action}'.format(action=action))
+        if action:
+            args += ['-a', action]
 
         for parameter in parameters:
-            cmd.append('-e {key} {value}'.format(
-                key=parameter, value=parameters[parameter]))
+            args += ['-e', parameter, parameters[parameter]]
 
-        self.__run(cmd)
+        return self.__start_template.line(*args)
+
+    def __start(self, handle, package_name, activity='MainActivity',
+                action=None, data_string=None, parameters={}):
+        self.__run_template(
+            handle, self.__start_template, self.__start_line(
+                package_name, activity, action, data_string, parameters))
+
+    def __press_line(self, button):
+        return self.__press_template.line(keycode(button))
 
     def __press(self, handle, button):
-        key_id = str(BUTTONS[button])
-        cmd = [self.adb, '-s', handle, 'shell', 'input', 'keyevent', key_id]
-        self.__run(cmd)
+        self.__run_template(
+            handle, self.__press_template, self.__press_line(button))
 
     def __shutdown(self, handle):
         cmd = [self.adb, '-s', handle, 'shell', 'reboot', '-p']
@@ -433,11 +1055,85 @@ class ADB(object):
         # Try with menu button
         self.__press(handle, 'menu')
 
-    def __tap(self, handle, location):
+    def __tap_line(self, location):
         x, y = 0, 1
-        cmd = [self.adb, '-s', handle, 'shell',
-               'input', 'tap', str(location[x]), str(location[y])]
-        self.__run(cmd)
+        return self.__tap_template.line(location[x], location[y])
+
+    def __tap(self, handle, location):
+        self.__run_template(
+            handle, self.__tap_template, self.__tap_line(location))
+
+    def __broadcast_to(self, handle, line, gate):
+        # Open the channel and make sure the shell is up before signalling
+        # that this device is ready, so only the command itself remains
+        # once all the devices are released. A device which isn't staged
+        # by the deadline is left out of the release.
+        channel = None
+        staged = False
+        try:
+            channel = Channel(self.adb, handle)
+            channel.send('true')
+            staged = channel.wait_ack(gate['deadline'] - time.time())
+            if not staged:
+                self.__print("Error: {}: shell didn't answer.".format(handle))
+        except Exception as e:
+            self.__print("Error: {}: {}".format(handle, e))
+        finally:
+            with gate['condition']:
+                gate['pending'] -= 1
+                if gate['pending'] == 0:
+                    gate['released'] = time.time()
+                    gate['condition'].notify_all()
+
+        try:
+            with gate['condition']:
+                while gate['pending'] > 0:
+                    gate['condition'].wait()
+            if not staged:
+                return (handle, None, None)
+            dispatched = time.time()
+            try:
+                channel.send(line)
+            except (IOError, OSError):
+                return (handle, None, None)
+            if not channel.wait_ack(gate['timeout']):
+                return (handle, dispatched, None)
+            return (handle, dispatched, time.time())
+        finally:
+            if channel is not None:
+                channel.close()
+
+    def __broadcast(self, line, timeout=20):
+        # Run a shell command on all devices at the same time. A channel is
+        # opened to every device at once, regardless of --threads. timeout
+        # applies to both the staging and the acknowledgement.
+        devices = self.__get_devices()
+        handles = [devices[d]["handle"] for d in devices]
+        print("running on {} devices.".format(len(handles)))
+        gate = {'condition': threading.Condition(), 'pending': len(handles),
+                'deadline': time.time() + timeout, 'timeout': timeout}
+        state = self.__dispatch(
+            self.__broadcast_to, handles,
+            dict(line=line, gate=gate))
+        state = [device for device in state if device is not None]
+
+        _id, dispatched, acked = 0, 1, 2
+        for device in sorted(state):
+            if device[acked] is None:
+                print("{:20} failed".format(device[_id]))
+                continue
+            print("{:20} dispatch +{:6.1f} ms ack +{:6.1f} ms".format(
+                device[_id],
+                (device[dispatched] - gate['released']) * 1000,
+                (device[acked] - gate['released']) * 1000))
+        done = [device for device in state if device[acked] is not None]
+        if done:
+            print("skew: dispatch {:.1f} ms, ack {:.1f} ms".format(
+                (max(d[dispatched] for d in done) -
+                 min(d[dispatched] for d in done)) * 1000,
+                (max(d[acked] for d in done) -
+                 min(d[acked] for d in done)) * 1000))
+        return state
 
     def __swipe(self, handle, start, end):
         x, y = 0, 1
@@ -457,17 +1153,233 @@ class ADB(object):
 
         self.__run(cmd)
 
-    def __multithreaded_cmd(self, cmd, **kwargs):
-        devices = self.__get_devices()
+    def __is_unchanged(self, path, size, mtime):
+        if not os.path.isfile(path):
+            return False
+        return os.path.getsize(path) == size and \
+            int(os.path.getmtime(path)) == int(mtime)
+
+    def __list_remote(self, handle, remote_dir):
+        # Return the size and mtime of the files below remote_dir by their
+        # relative path, or None if the device couldn't list them. The
+        # trailing / makes find follow a remote_dir which is a symlink,
+        # like /sdcard.
+        prefix = remote_dir.rstrip('/') + '/'
+        cmd = [self.adb, '-s', handle, 'shell',
+               'find', quote(prefix), '-type', 'f',
+               '-exec', 'stat', '-c', quote('%s %Y %n'), '{}', '+']
+        output, _, returncode = self.__run(
+            cmd, timeout=None, max_output=None)
+        if output is None or returncode != 0:
+            return None
+
+        files = {}
+        for line in output.splitlines():
+            line = line.strip().split(' ', 2)
+            if len(line) != 3 or not line[2].startswith(prefix):
+                continue
+            try:
+                files[line[2][len(prefix):].lstrip('/')] = \
+                    (int(line[0]), int(line[1]))
+            except ValueError:
+                continue
+        return files
+
+    def __pull_tar(self, handle, remote_dir, destination, throttle, paths):
+        # Stream the paths as a single tar and extract it while it arrives.
+        # Returns None if the device could not produce a tar.
+        # tarfile is only imported here, as it noticeably adds to the start
+        # time of every other command.
+        import tarfile
+        cmd = [self.adb, '-s', handle, 'exec-out',
+               'tar', '-cf', '-', '-C', quote(remote_dir)]
+        cmd += [quote(path) for path in paths]
+        pulled, unchanged = 0, 0
+        devnull = open(os.devnull, 'w')
+        self.cmd_semaphore.acquire()
+        try:
+            process = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=devnull)
+            try:
+                stream = ThrottledReader(process.stdout, throttle)
+                tar = tarfile.open(fileobj=stream, mode='r|')
+                for member in tar:
+                    name = os.path.normpath(member.name)
+                    if os.path.isabs(name) or name.startswith('..'):
+                        continue
+                    path = os.path.join(destination, name)
+                    if member.isdir():
+                        if not os.path.isdir(path):
+                            os.makedirs(path)
+                        continue
+                    if not member.isfile():
+                        continue
+                    if self.__is_unchanged(path, member.size, member.mtime):
+                        unchanged += 1
+                        continue
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    source = tar.extractfile(member)
+                    with open(path, 'wb') as f:
+                        while True:
+                            chunk = source.read(64 * 1024)
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                    os.utime(path, (member.mtime, member.mtime))
+                    pulled += 1
+                tar.close()
+            except tarfile.TarError:
+                process.kill()
+                process.wait()
+                return None
+            finally:
+                process.stdout.close()
+            if process.wait() != 0 and pulled + unchanged == 0:
+                return None
+        finally:
+            devnull.close()
+            self.cmd_semaphore.release()
+        return pulled, unchanged, 0
+
+    def __pull_files(self, handle, remote_dir, destination, throttle, files,
+                     paths):
+        # Fallback for devices without tar, pull the files one by one.
+        pulled, failed = 0, 0
+        for name in paths:
+            size, mtime = files[name]
+            path = os.path.join(destination, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            remote = remote_dir.rstrip('/') + '/' + name
+            _, _, returncode = self.__run(
+                [self.adb, '-s', handle, 'pull', remote, path], timeout=None)
+            if returncode != 0:
+                self.__print("Error: {}: unable to pull {}.".format(
+                    handle, remote))
+                failed += 1
+                continue
+            throttle.consume(size)
+            os.utime(path, (mtime, mtime))
+            pulled += 1
+        return pulled, 0, failed
+
+    def __batches(self, paths, size=16 * 1024):
+        # Split the paths so each tar command line stays reasonably short.
+        batch, length = [], 0
+        for path in paths:
+            if batch and length + len(path) > size:
+                yield batch
+                batch, length = [], 0
+            batch.append(path)
+            length += len(path) + 3
+        if batch:
+            yield batch
+
+    def __pull(self, handle, remote_dir, local_dir, throttle):
+        destination = os.path.join(local_dir, handle)
+        try:
+            if not os.path.isdir(destination):
+                os.makedirs(destination)
+
+            files = self.__list_remote(handle, remote_dir)
+            if not files:
+                # Unchanged files can then only be skipped on arrival.
+                result = self.__pull_tar(
+                    handle, remote_dir, destination, throttle, ['.'])
+                if result is None:
+                    self.__print("Error: {}: unable to pull {}.".format(
+                        handle, remote_dir))
+                    return None
+            else:
+                # Only transfer the files which changed since the last pull.
+                changed = sorted(
+                    name for name in files if not self.__is_unchanged(
+                        os.path.join(destination, name), *files[name]))
+                pulled, unchanged, failed = 0, len(files) - len(changed), 0
+                batches = [['.']] if len(changed) == len(files) and \
+                    changed else self.__batches(changed)
+                for batch in batches:
+                    result = self.__pull_tar(
+                        handle, remote_dir, destination, throttle, batch)
+                    if result is None:
+                        if batch == ['.']:
+                            batch = changed
+                        result = self.__pull_files(
+                            handle, remote_dir, destination, throttle, files,
+                            batch)
+                    pulled += result[0]
+                    unchanged += result[1]
+                    failed += result[2]
+                result = (pulled, unchanged, failed)
+        except (IOError, OSError) as e:
+            self.__print("Error: {}: {}".format(handle, e))
+            return None
+
+        self.__print("{}: {} file(s) pulled, {} unchanged, {} failed.".format(
+            handle, *result))
+        return result
+
+    def __track_devices(self, attached, deadline):
+        # Set the event of each handle in attached when the adb server
+        # reports the device as ready, using the server's track-devices
+        # stream instead of polling.
+        connection = self.__host_request(
+            'host:track-devices', max(deadline - time.time(), 0.1))
+        if connection is None:
+            # Without the event stream, leave it to the probes to notice.
+            for event in attached.values():
+                event.set()
+            return
+        try:
+            while not all(event.is_set() for event in attached.values()):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                connection.settimeout(remaining)
+                size = int(self.__recv_exactly(connection, 4), 16)
+                devices = self.__recv_exactly(connection, size)
+                for line in devices.decode('utf-8', 'replace').splitlines():
+                    line = line.split()
+                    if len(line) == 2 and line[1] == 'device' and \
+                            line[0] in attached:
+                        attached[line[0]].set()
+        except (socket.error, socket.timeout, ValueError):
+            # The stream broke, fall back to the probes as above.
+            for event in attached.values():
+                event.set()
+        finally:
+            connection.close()
+
+    def __wait_for(self, handle, probe, attached, start, deadline):
+        if not attached[handle].wait(max(deadline - time.time(), 0)):
+            return (handle, None)
+
+        # Poll the cheap probe with an exponential backoff, without letting
+        # the probe itself run past the deadline.
+        delay = 0.1
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return (handle, None)
+            if probe(handle, remaining):
+                return (handle, time.time() - start)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return (handle, None)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 2.0)
+
+    def __dispatch(self, cmd, handles, kwargs):
         threads = []
         results = []
 
         class FuncThread(threading.Thread):
             def __init__(self, target, **kwargs):
+                threading.Thread.__init__(self)
                 self._target = target
                 self._kwargs = kwargs
                 self.result = None
-                threading.Thread.__init__(self)
 
             def run(self):
                 self.result = self._target(**self._kwargs)
@@ -475,9 +1387,8 @@ class ADB(object):
             def join(self):
                 threading.Thread.join(self)
                 return self.result
-        print("running on {} devices.".format(len(devices)))
-        for d in devices:
-            t = FuncThread(target=cmd, handle=devices[d]["handle"], **kwargs)
+        for handle in handles:
+            t = FuncThread(target=cmd, handle=handle, **kwargs)
             t.start()
             threads.append(t)
 
@@ -486,6 +1397,12 @@ class ADB(object):
 
         return results
 
+    def __multithreaded_cmd(self, cmd, **kwargs):
+        devices = self.__get_devices()
+        handles = [devices[d]["handle"] for d in devices]
+        print("running on {} devices.".format(len(handles)))
+        return self.__dispatch(cmd, handles, kwargs)
+
     def list_quick(self):
         """List the devices quickly."""
         devices = self.__get_devices()
@@ -505,20 +1422,17 @@ class ADB(object):
             print("No devices detected.")
             return
 
+        self.__index(list(devices), Selector.FIELDS)
+
         longest_line = 0
         for d in sorted(devices.keys()):
-            handle = devices[d]['handle']
-            devices[d]['version'] = "{}.{}.{}".format(*self.__version(handle))
-            devices[d]['brand'] = self.__brand(handle)
-            devices[d]['model'] = self.__model(handle)
-            devices[d]['battery'] = self.__battery(handle)
-
-            if self.__is_off(devices[d]['handle']):
-                devices[d]['state'] = 'device off'
-            else:
-                screen_on = self.__is_screen_on(handle)
-                devices[d]['state'] = \
-                    'screen on' if screen_on else 'screen off'
+            info = self.__device_info[d]
+            devices[d]['version'] = str(info['version'])
+            devices[d]['brand'] = info['brand']
+            devices[d]['model'] = info['model']
+            devices[d]['battery'] = \
+                "-" if info['battery'] is None else info['battery']
+            devices[d]['state'] = info['state']
             m = "{id:20} " \
                 "{brand:10} " \
                 "{model:12} " \
@@ -534,7 +1448,12 @@ class ADB(object):
 
     def tap(self, location):
         """Tao on the screen."""
-        self.__multithreaded_cmd(self.__tap, location=location)
+        line = self.__tap_line(location)
+        if self.sync:
+            self.__broadcast(line)
+            return
+        self.__multithreaded_cmd(
+            self.__run_template, template=self.__tap_template, line=line)
 
     def swipe(self, start, end):
         """Swipe between two points."""
@@ -542,22 +1461,63 @@ class ADB(object):
 
     def press(self, button):
         """Press a button."""
-        self.__multithreaded_cmd(self.__press, button=button)
+        line = self.__press_line(button)
+        if self.sync:
+            self.__broadcast(line)
+            return
+        self.__multithreaded_cmd(
+            self.__run_template, template=self.__press_template, line=line)
 
     def turn_screen(self, turn):
         """Turn the screen."""
         self.__multithreaded_cmd(self.__turn_screen, turn=turn)
 
-    def install(self, apk):
-        """Install apk."""
-        def cmd(handle, apk):
-            result = self.__install(handle, apk)
-            stdout = result[0].splitlines()
-            if stdout:
-                self.__print(stdout[-1])
-            else:
-                print(result[1])
-        self.__multithreaded_cmd(cmd, apk=apk)
+    def install(self, apks):
+        """Install APKs.
+
+        Each entry of apks is either the path of an APK or a list with the
+        paths of a base APK and its splits. Each application is installed
+        in a single install session per device, and the result is printed
+        for each device and APK.
+        """
+        if not isinstance(apks, list):
+            apks = [apks]
+        apps = [[apk] if not isinstance(apk, list) else apk for apk in apks]
+        unreadable = [
+            apk for app in apps for apk in app
+            if not os.path.isfile(apk) or not os.access(apk, os.R_OK)]
+        if unreadable:
+            print("Error: unable to read {}.".format(", ".join(unreadable)))
+            return
+
+        state = self.__multithreaded_cmd(self.__install_apps, apps=apps)
+        failed = len([device for device in state if device is None])
+        state = [device for device in state if device is not None]
+
+        names = [os.path.basename(apk) for app in apps for apk in app]
+        widths = [max(len(name), 7) for name in names]
+        print(" ".join(["{:20}".format("device")] +
+                       ["{:{}}".format(n, w) for n, w in zip(names, widths)]))
+        _id, results, phases = 0, 1, 2
+        failures = []
+        for device in sorted(state):
+            cells = []
+            for name, result, width in zip(names, device[results], widths):
+                if result.startswith('Success'):
+                    cells.append("{:{}}".format("ok", width))
+                else:
+                    cells.append("{:{}}".format("FAILED", width))
+                    failures.append((device[_id], name, result))
+            timings = ", ".join(
+                "{} {:.1f} s".format(phase, device[phases][phase])
+                for phase in ['create', 'write', 'commit', 'install']
+                if phase in device[phases])
+            print(" ".join(["{:20}".format(device[_id])] + cells +
+                           ["({})".format(timings)]))
+        for failure in failures:
+            print("{}: {}: {}".format(*failure))
+        if failed:
+            print("{} device(s) failed.".format(failed))
 
     def uninstall(self, package_name):
         """Uninstall package."""
@@ -601,9 +1561,13 @@ class ADB(object):
     def start(self, package_name, activity='MainActivity', action=None,
               data_string=None, parameters={}):
         """Start application."""
+        line = self.__start_line(
+            package_name, activity, action, data_string, parameters)
+        if self.sync:
+            self.__broadcast(line)
+            return
         self.__multithreaded_cmd(
-            self.__start, package_name=package_name, activity=activity,
-            action=action, data_string=data_string, parameters=parameters)
+            self.__run_template, template=self.__start_template, line=line)
 
     def stop(self, package_name):
         """Stop application."""
@@ -633,12 +1597,102 @@ class ADB(object):
         """Unlock device."""
         self.__multithreaded_cmd(self.__unlock)
 
+    def pull(self, remote_dir, local_dir, bandwidth=None):
+        """Pull a directory from the devices into local_dir/<serial>."""
+        rate = bandwidth * 1024 * 1024 if bandwidth else None
+        results = self.__multithreaded_cmd(
+            self.__pull, remote_dir=remote_dir, local_dir=local_dir,
+            throttle=Throttle(rate))
+        failed = len([result for result in results if result is None])
+        results = [result for result in results if result is not None]
+        print("total: {} file(s) pulled, {} unchanged, {} failed.".format(
+            sum(result[0] for result in results),
+            sum(result[1] for result in results),
+            sum(result[2] for result in results)))
+        if failed:
+            print("{}/{} devices failed.".format(
+                failed, failed + len(results)))
+
+    def wait_for(self, condition, package_name=None, timeout=120):
+        """Wait for a condition on the devices.
+
+        The condition is one of 'device', 'boot_completed', 'running' or
+        'screen_on'. Returns a dict with the seconds it took for each device
+        to become ready, or None if it did not within the timeout.
+        """
+        start = time.time()
+        deadline = start + timeout
+        probes = {
+            'device': lambda handle, timeout:
+                self.__get_state(handle, timeout) == 'device',
+            'boot_completed': lambda handle, timeout:
+                self.__get_prop(
+                    handle, 'sys.boot_completed', timeout) == '1',
+            'running': lambda handle, timeout:
+                self.__running(handle, package_name, timeout)[1],
+            'screen_on': lambda handle, timeout:
+                self.__is_screen_on(handle, timeout) and
+                not self.__is_screen_locked(
+                    handle, max(deadline - time.time(), 0.1))
+        }
+
+        # Devices which are rebooting are not listed, so when specific
+        # devices are given, wait for those. Their properties can't be
+        # fetched while they are away, so a selector can't be applied.
+        if self.specific_devices and self.where:
+            raise ValueError("wait_for can't use both specific devices and "
+                             "a selector")
+        if self.specific_devices:
+            self.__start_server()
+            handles = list(self.specific_devices)
+        else:
+            handles = list(self.__get_devices())
+
+        attached = {handle: threading.Event() for handle in handles}
+        tracker = threading.Thread(
+            target=self.__track_devices, args=(attached, deadline))
+        tracker.daemon = True
+        tracker.start()
+
+        state = self.__dispatch(
+            self.__wait_for, handles,
+            dict(probe=probes[condition], attached=attached, start=start,
+                 deadline=deadline))
+
+        _id, elapsed = 0, 1
+        for device in sorted(state):
+            if device[elapsed] is None:
+                print("{:20} not ready".format(device[_id]))
+            else:
+                print("{:20} ready after {:.1f} s".format(
+                    device[_id], device[elapsed]))
+        print("{}/{} devices ready.".format(
+            len([device for device in state if device[elapsed] is not None]),
+            len(state)))
+        return dict(state)
+
     def shell(self, arguments, log_type):
         output_mutex = threading.Lock()
         output = {}
 
         def run_shell(handle):
             cmd = [self.adb, '-s', handle, 'shell'] + arguments
+            if log_type == 'file':
+                # Write the lines as they arrive instead of keeping them.
+                fout = open("device_{id}.out".format(id=handle), 'wb')
+
+                def write_line(line):
+                    fout.write(line + b'\n')
+                try:
+                    self.__run(cmd, timeout=None, max_output=0,
+                               line_callback=write_line)
+                finally:
+                    fout.close()
+                return
+            if log_type == 'none':
+                self.__run(cmd, timeout=None, max_output=0)
+                return
+
             out, err, ret = self.__run(cmd, timeout=None)
 
             output_mutex.acquire()
@@ -647,22 +1701,12 @@ class ADB(object):
 
         self.__multithreaded_cmd(run_shell)
 
-        def file_logging(handle, content):
-            fout = open("device_{id}.out".format(id=handle), 'w')
-            fout.write(content);
-            fout.close()
-
         def stdout_logging(handle, content):
             print("Device: {id}\nOutput:\n{entry}".format(id=handle,
                 entry=content))
 
         for key, entry in output.items():
-            if log_type == 'none':
-                return
-            elif log_type == 'stdout':
-                stdout_logging(key, entry)
-            elif log_type == 'file':
-                file_logging(key, entry)
+            stdout_logging(key, entry)
 
 
 def main():
@@ -704,6 +1748,27 @@ def main():
         help='Command to be executed, including arguments',
         nargs='+')
 
+    parser.add_argument(
+        '--sync',
+        help="Release start, tap and press on all devices at the same time "
+             "and report the skew between the devices.",
+        action='store_true')
+
+    def selector(input):
+        try:
+            return Selector(input)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(
+                "Invalid selector: {}".format(e))
+
+    parser.add_argument(
+        '--where',
+        help="Only use the devices matching a selector, e.g. "
+             "\"model=='Nexus 4' and version>=7 and battery>30\". The "
+             "fields are: {}".format(", ".join(Selector.FIELDS)),
+        type=selector,
+        default=None)
+
     def coordinate(input):
         try:
             x, y = map(int, input.split(','))
@@ -734,11 +1799,20 @@ def main():
         help="The end of the swipe (x,y)",
         type=coordinate)
 
+    def button(input):
+        try:
+            keycode(input)
+            return input
+        except KeyError:
+            raise argparse.ArgumentTypeError(
+                "Unknown button '{}'".format(input))
+
     press_parser = subparsers.add_parser('press', help="Press a button.")
     press_parser.add_argument(
         'button',
-        help="Button to press.",
-        choices=BUTTONS.keys())
+        help="Button to press, either one of {{{}}} or the name of an "
+             "Android KEYCODE_* constant.".format(",".join(BUTTONS)),
+        type=button)
 
     subparsers.add_parser('shutdown', help="Shutdown device(s).")
 
@@ -753,8 +1827,21 @@ def main():
         choices=turn_values.keys(),
         help='Turn the screen on or off.')
 
+    def apk_set(input):
+        apks = input.split(',')
+        for apk in apks:
+            if not os.path.isfile(apk) or not os.access(apk, os.R_OK):
+                raise argparse.ArgumentTypeError(
+                    "Unable to read APK '{}'".format(apk))
+        return apks
+
     install_parser = subparsers.add_parser('install', help='Install APK.')
-    install_parser.add_argument('apk', help="APK to install.", nargs='?')
+    install_parser.add_argument(
+        'apk',
+        help="APK(s) to install. The APKs of an application split into "
+             "several APKs are given comma separated, base APK first.",
+        type=apk_set,
+        nargs='+')
 
     uninstall_parser = subparsers.add_parser(
         'uninstall',
@@ -810,17 +1897,58 @@ def main():
         'package_name',
         help='Package name of the application to restart')
 
+    pull_parser = subparsers.add_parser(
+        'pull',
+        help="Pull a directory from the device(s) into local_dir/<serial>.")
+    pull_parser.add_argument(
+        'remote_dir',
+        help='Directory on the device to pull')
+    pull_parser.add_argument(
+        'local_dir',
+        help='Local directory to pull into')
+    pull_parser.add_argument(
+        '--bandwidth',
+        type=float,
+        default=None,
+        help='Combined bandwidth limit for all devices in MB/s')
+
+    wait_for_parser = subparsers.add_parser(
+        'wait-for',
+        help="Wait for a condition to be met on the device(s).")
+    wait_for_parser.add_argument(
+        'condition',
+        choices=['device', 'boot_completed', 'running', 'screen_on'],
+        help='The condition to wait for, screen_on also requires the screen '
+             'to be unlocked')
+    wait_for_parser.add_argument(
+        'package_name',
+        nargs='?',
+        help='Package name of the application, used by running')
+    wait_for_parser.add_argument(
+        '--timeout',
+        type=float,
+        default=120,
+        help='Overall time to wait in seconds')
+
     subparsers.add_parser('unlock', help="Unlocks the screen. Note, this "
                                          "command only works on Huawei "
                                          "T1_A21L units.")
 
     args = parser.parse_args()
-    adb = ADB(args.adb, args.threads, args.specific_devices)
+    if args.command == 'wait-for' and args.condition == 'running' and \
+            not args.package_name:
+        parser.error("wait-for running requires a package_name")
+    if args.command == 'wait-for' and args.specific_devices and args.where:
+        parser.error("wait-for can't use -s and --where together")
+    if args.sync and args.command not in ['start', 'tap', 'press']:
+        parser.error("--sync is only supported by start, tap and press")
+    adb = ADB(args.adb, args.threads, args.specific_devices, args.where,
+              args.sync)
     if 'extras' in dir(args):
         args.extras = \
             {extra.split('=')[0]: extra.split('=')[1] for extra in args.extras}
 
-    {
+    result = {
         'list': lambda args: adb.list_quick() if args.quick else adb.list(),
         'tap': lambda args: adb.tap(args.location),
         'swipe': lambda args: adb.swipe(args.start, args.end),
@@ -839,9 +1967,18 @@ def main():
         'stop': lambda args: adb.stop(args.package_name),
         'shell': lambda args: adb.shell(args.shell_command, args.log_type),
         'restart': lambda args: adb.restart(args.package_name),
+        'wait-for': lambda args: adb.wait_for(args.condition,
+                                              args.package_name,
+                                              args.timeout),
+        'pull': lambda args: adb.pull(args.remote_dir, args.local_dir,
+                                      args.bandwidth),
         'unlock': lambda args: adb.unlock()
     }[args.command](args)
 
+    if args.command == 'wait-for':
+        if not result or None in result.values():
+            sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) 2015 Steinwurf ApS
+# All Rights Reserved
+#
+# Distributed under the "BSD License". See the accompanying LICENSE.rst file.
+
+"""Measure the per-command dispatch cost of the input commands.
+
+The first part times building the adb command of a press, tap and start for
+a fleet of devices using CommandTemplate, against building and quoting the
+whole command for every device. The second part times 'press' through ADB
+against a stub adb executable, i.e. including the process spawn.
+"""
+
+import argparse
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import adb  # noqa: E402
+
+STUB_ADB = """#! {python}
+import sys
+if sys.argv[1] == 'devices':
+    print('List of devices attached')
+    for i in range({devices}):
+        print('device{{:04}}\\tdevice'.format(i))
+"""
+
+OPERATIONS = {
+    'press': (['input', 'keyevent'], lambda: [adb.keycode('home')]),
+    'tap': (['input', 'tap'], lambda: [540, 960]),
+    'start': (['am', 'start'],
+              lambda: ['-n', 'com.company.app/.MainActivity',
+                       '-e', 'message', 'hello world']),
+}
+
+
+def templated(template, args, handles):
+    """Quote the arguments once and only fill in the serial per device."""
+    line = template.line(*args())
+    return [template.argv(handle, line) for handle in handles]
+
+
+def rebuilt(prefix, args, handles):
+    """Build and quote the whole command for every device."""
+    return [['adb', '-s', handle, 'shell',
+             " ".join(adb.quote(str(arg)) for arg in prefix + args())]
+            for handle in handles]
+
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--devices', type=int, default=50, help='the number of devices')
+    parser.add_argument(
+        '--commands', type=int, default=2000,
+        help='the number of commands to build per operation')
+    parser.add_argument(
+        '--spawn_runs', type=int, default=3,
+        help='the number of presses to run against the stub adb')
+    args = parser.parse_args()
+
+    handles = ['device{:04}'.format(i) for i in range(args.devices)]
+    print("Building commands for {} devices:".format(args.devices))
+    for name in sorted(OPERATIONS):
+        prefix, arguments = OPERATIONS[name]
+        template = adb.CommandTemplate('adb', prefix)
+        results = []
+        for function in [lambda: templated(template, arguments, handles),
+                         lambda: rebuilt(prefix, arguments, handles)]:
+            seconds = min(timeit.repeat(
+                function, number=args.commands // 10, repeat=10))
+            results.append(
+                seconds / (args.commands // 10) / args.devices * 1e6)
+        print("  {:6} {:.2f} us/device templated, {:.2f} us/device "
+              "rebuilt".format(name, *results))
+
+    directory = tempfile.mkdtemp()
+    try:
+        stub = os.path.join(directory, 'adb')
+        with open(stub, 'w') as f:
+            f.write(STUB_ADB.format(
+                python=sys.executable, devices=args.devices))
+        os.chmod(stub, os.stat(stub).st_mode | stat.S_IEXEC)
+
+        device = adb.ADB(stub, threads=10, specific_devices=[])
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            seconds = min(timeit.repeat(
+                lambda: device.press('home'), number=1,
+                repeat=args.spawn_runs))
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        print("press through ADB with a stub adb: {:.1f} ms/device".format(
+            seconds / args.devices * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) 2015 Steinwurf ApS
+# All Rights Reserved
+#
+# Distributed under the "BSD License". See the accompanying LICENSE.rst file.
+
+"""Measure the startup time of 'adb.py list --quick' against a stub server.
+
+A stub adb server answering host:version listens on a local port and a stub
+adb executable lists a single device. The benchmark fails if adb.py spawns
+'adb start-server' or if the median wall time exceeds the budget.
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ADB_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'adb.py')
+
+STUB_ADB = """#! {python}
+import sys
+if sys.argv[1] == 'start-server':
+    open({marker!r}, 'w').close()
+elif sys.argv[1] == 'devices':
+    print('List of devices attached')
+    print('0123456789\\tdevice')
+"""
+
+
+def serve(server):
+    """Answer host requests with OKAY like the adb server does."""
+    while True:
+        connection, _ = server.accept()
+        try:
+            size = int(connection.recv(4), 16)
+            connection.recv(size)
+            connection.sendall(b'OKAY00040029')
+        finally:
+            connection.close()
+
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--runs', type=int, default=10, help='the number of runs')
+    parser.add_argument(
+        '--budget', type=float, default=0.5,
+        help='the maximum median wall time in seconds')
+    args = parser.parse_args()
+
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    thread = threading.Thread(target=serve, args=(server,))
+    thread.daemon = True
+    thread.start()
+
+    directory = tempfile.mkdtemp()
+    try:
+        marker = os.path.join(directory, 'start-server')
+        adb = os.path.join(directory, 'adb')
+        with open(adb, 'w') as f:
+            f.write(STUB_ADB.format(python=sys.executable, marker=marker))
+        os.chmod(adb, os.stat(adb).st_mode | stat.S_IEXEC)
+
+        env = dict(os.environ)
+        env['ANDROID_ADB_SERVER_PORT'] = str(server.getsockname()[1])
+        cmd = [sys.executable, ADB_PY, '--adb', adb, 'list', '--quick']
+
+        times = []
+        for _ in range(args.runs):
+            start = time.time()
+            subprocess.check_call(cmd, env=env, stdout=subprocess.PIPE)
+            times.append(time.time() - start)
+
+        if os.path.exists(marker):
+            sys.exit("FAILED: 'adb start-server' was run although the "
+                     "server was up.")
+    finally:
+        shutil.rmtree(directory)
+
+    median = sorted(times)[len(times) // 2]
+    print("list --quick: median {:.1f} ms, min {:.1f} ms, max {:.1f} ms "
+          "({} runs)".format(median * 1000, min(times) * 1000,
+                             max(times) * 1000, len(times)))
+    if median > args.budget:
+        sys.exit("FAILED: median exceeds the budget of {:.1f} ms.".format(
+            args.budget * 1000))
+
+
+if __name__ == '__main__':
+    main()